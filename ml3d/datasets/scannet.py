@@ -62,7 +62,7 @@ class Scannet(BaseDataset):
         available_scenes = []
         files = os.listdir(dataset_path)
         for f in files:
-            if 'scene' in f and f.endswith('.npy'):
+            if 'scene' in f and f.endswith('.npz'):
                 available_scenes.append(f[:12])
 
         available_scenes = list(set(available_scenes))
@@ -97,14 +97,15 @@ class Scannet(BaseDataset):
     @staticmethod
     def read_lidar(path):
         assert Path(path).exists()
-        data = np.load(path)
+        data = np.load(path)['vert']
 
         return data
 
     def read_label(self, scene):
-        instance_mask = np.load(scene + '_ins_label.npy')
-        semantic_mask = np.load(scene + '_sem_label.npy')
-        bboxes = np.load(scene + '_bbox.npy')
+        data = np.load(scene + '.npz')
+        instance_mask = data['ins']
+        semantic_mask = data['sem']
+        bboxes = data['bbox']
 
         ## For filtering semantic labels to have same classes as object detection.
         # for i in range(semantic_mask.shape[0]):
@@ -176,7 +177,7 @@ class ScannetSplit(BaseDatasetSplit):
     def get_data(self, idx):
         scene = self.path_list[idx]
 
-        pc = self.dataset.read_lidar(scene + '_vert.npy')
+        pc = self.dataset.read_lidar(scene + '.npz')
         feat = pc[:, 3:]
         pc = pc[:, :3]
 
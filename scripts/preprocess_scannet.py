@@ -6,9 +6,16 @@ from os.path import join
 import argparse
 import json
 import csv
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 import open3d as o3d
 from tqdm import tqdm
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Preprocess Scannet Dataset.')
@@ -19,6 +26,9 @@ def parse_args():
                         help='Output path to store processed data.',
                         default=None,
                         required=False)
+    parser.add_argument('--overwrite',
+                        help='Reprocess scans whose output already exists.',
+                        action='store_true')
 
     args = parser.parse_args()
 
@@ -47,41 +57,126 @@ def represents_int(s):
         return False
 
 
+def load_json(filename):
+    """Load a json file, using orjson when it is installed.
+
+    Args:
+        filename(str): Path of the json file.
+
+    Returns:
+        The decoded json data.
+    """
+    if orjson is None:
+        with open(filename) as f:
+            return json.load(f)
+    with open(filename, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+_processor = None
+
+
+def _init_worker(processor):
+    """Store the converter in the worker process, so that only the scan name
+    has to be sent with every task.
+    """
+    global _processor
+    _processor = processor
+
+
+def _safe_process(scan):
+    """Process a single scan in a worker process.
+
+    Args:
+        scan(str): Name of the scan to process.
+
+    Returns:
+        str: Traceback of the raised exception, or None on success.
+    """
+    try:
+        _processor.process_scene(scan)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
 class ScannetProcess():
     """Preprocess Scannet.
 
-    This class converts Scannet raw data into npy files.
+    This class converts Scannet raw data into one npz file per scan.
 
     Args:
         dataset_path (str): Directory to load argoverse data.
         out_path (str): Directory to save pickle file(infos).
+        max_num_point (int): Scans with more points are randomly subsampled.
+        overwrite (bool): Reprocess scans whose output already exists.
     """
 
-    def __init__(self, dataset_path, out_path, max_num_point=10000000):
+    def __init__(self,
+                 dataset_path,
+                 out_path,
+                 max_num_point=10000000,
+                 overwrite=False):
 
         self.out_path = out_path
         self.dataset_path = dataset_path
         self.max_num_point = max_num_point
+        self.overwrite = overwrite
 
-        scans = os.listdir(dataset_path)
-        self.scans = []
-        for scan in scans:
-            name = scan.split('/')[-1]
-            if 'scene' in name and len(name) == 12:
-                self.scans.append(scan)
+        self.scans = sorted(entry.name
+                            for entry in os.scandir(dataset_path)
+                            if entry.is_dir() and len(entry.name) == 12 and
+                            entry.name.startswith('scene'))
 
         self.DONOTCARE_IDS = np.array([])
         self.OBJ_CLASS_IDS = np.array(
             [3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 14, 16, 24, 28, 33, 34, 36, 39])
+        self._care_lut = np.zeros(256, dtype=bool)
+        self._care_lut[self.OBJ_CLASS_IDS] = True
+
+        label_map_file = str(
+            Path(__file__).parent /
+            '../ml3d/datasets/_resources/scannet/scannetv2-labels.combined.tsv')
+        self.label_map = self.read_label_mapping(label_map_file,
+                                                 label_from='raw_category',
+                                                 label_to='nyu40id')
 
         print(f"Total number of scans : {len(self.scans)}")
 
     def convert(self):
-        for scan in tqdm(self.scans):
-            try:
-                self.process_scene(scan)
-            except Exception as e:
-                print(e)
+        os.makedirs(self.out_path, exist_ok=True)
+        # Drop failures reported by a previous run, retried scans may succeed.
+        errors_file = join(self.out_path, 'errors.txt')
+        if os.path.exists(errors_file):
+            os.remove(errors_file)
+
+        if self.overwrite:
+            todo = self.scans
+        else:
+            # Skip scans whose output already exists, so that an interrupted
+            # run can be resumed. Outputs are renamed into place only once
+            # complete, so an existing file is never a partial write.
+            done = set(os.listdir(self.out_path))
+            todo = [scan for scan in self.scans if f'{scan}.npz' not in done]
+            print(f"Skipping {len(self.scans) - len(todo)} processed scans, "
+                  "use --overwrite to reprocess them")
+
+        errors = {}
+        with ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as ex:
+            results = ex.map(_safe_process, todo, chunksize=1)
+            for scan, err in tqdm(zip(todo, results), total=len(todo)):
+                if err is not None:
+                    errors[scan] = err
+
+        errmsg = ''
+        for scan, err in errors.items():
+            errmsg += f"Failed to process {scan}:\n{err}\n"
+        if errmsg:
+            print(errmsg)
+            with open(errors_file, 'w') as errfile:
+                errfile.write(errmsg)
 
     def process_scene(self, scan):
         in_path = join(self.dataset_path, scan)
@@ -91,101 +186,125 @@ class ScannetProcess():
         seg_file = join(in_path, scan + '_vh_clean_2.0.010000.segs.json')
 
         meta_file = join(in_path, scan + '.txt')
-        label_map_file = str(
-            Path(__file__).parent /
-            '../ml3d/datasets/_resources/scannet/scannetv2-labels.combined.tsv')
         mesh_vertices, semantic_labels, instance_labels, instance_bboxes, instance2semantic = self.export(
-            mesh_file, agg_file, seg_file, meta_file, label_map_file)
+            mesh_file, agg_file, seg_file, meta_file, self.label_map)
 
-        mask = np.logical_not(np.in1d(semantic_labels, self.DONOTCARE_IDS))
-        mesh_vertices = mesh_vertices[mask, :]
-        semantic_labels = semantic_labels[mask]
-        instance_labels = instance_labels[mask]
+        if self.DONOTCARE_IDS.size:
+            idx = np.flatnonzero(
+                np.isin(semantic_labels, self.DONOTCARE_IDS, invert=True))
+            mesh_vertices = mesh_vertices.take(idx, axis=0)
+            semantic_labels = semantic_labels.take(idx)
+            instance_labels = instance_labels.take(idx)
 
-        num_instances = len(np.unique(instance_labels))
-        print(f'Num of instances: {num_instances}')
-
-        bbox_mask = np.in1d(instance_bboxes[:, -1], self.OBJ_CLASS_IDS)
+        bbox_mask = self._care_lut[instance_bboxes[:, -1].astype(np.int64)]
         instance_bboxes = instance_bboxes[bbox_mask, :]
         print(f'Num of care instances: {instance_bboxes.shape[0]}')
 
         N = mesh_vertices.shape[0]
         if N > self.max_num_point:
-            choices = np.random.choice(N, self.max_num_point, replace=False)
-            mesh_vertices = mesh_vertices[choices, :]
-            semantic_labels = semantic_labels[choices]
-            instance_labels = instance_labels[choices]
-
-        np.save(f'{join(self.out_path, scan)}_vert.npy', mesh_vertices)
-        np.save(f'{join(self.out_path, scan)}_sem_label.npy', semantic_labels)
-        np.save(f'{join(self.out_path, scan)}_ins_label.npy', instance_labels)
-        np.save(f'{join(self.out_path, scan)}_bbox.npy', instance_bboxes)
-
-    def export(self, mesh_file, agg_file, seg_file, meta_file, label_map_file):
+            # Unlike np.random.choice, Generator.choice samples without
+            # replacement without permuting all N indices.
+            rng = np.random.default_rng()
+            choices = rng.choice(N, self.max_num_point, replace=False)
+            mesh_vertices = mesh_vertices.take(choices, axis=0)
+            semantic_labels = semantic_labels.take(choices)
+            instance_labels = instance_labels.take(choices)
+
+        # Write to a temporary file and rename it, so that an interrupted run
+        # never leaves a partial archive under the final name.
+        out_file = join(self.out_path, f'{scan}.npz')
+        tmp_file = f'{out_file}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f,
+                     vert=mesh_vertices,
+                     sem=semantic_labels,
+                     ins=instance_labels,
+                     bbox=instance_bboxes)
+        os.replace(tmp_file, out_file)
+
+    def export(self, mesh_file, agg_file, seg_file, meta_file, label_map):
         mesh_vertices = self.read_mesh_vertices_rgb(mesh_file)
-        label_map = self.read_label_mapping(label_map_file,
-                                            label_from='raw_category',
-                                            label_to='nyu40id')
 
         # Load axis alignment matrix
-        lines = open(meta_file).readlines()
         axis_align_matrix = np.eye(4)
-        for line in lines:
-            if 'axisAlignment' in line:
-                axis_align_matrix = [
-                    float(x)
-                    for x in line.rstrip().strip('axisAlignment = ').split(' ')
-                ]
-                break
-        axis_align_matrix = np.array(axis_align_matrix).reshape((4, 4))
-        pts = np.ones((mesh_vertices.shape[0], 4))
-        pts[:, 0:3] = mesh_vertices[:, 0:3]
-        pts = np.dot(pts, axis_align_matrix.transpose())
-        mesh_vertices[:, 0:3] = pts[:, 0:3]
+        with open(meta_file) as f:
+            for line in f:
+                if line.startswith('axisAlignment'):
+                    axis_align_matrix = np.fromstring(line.split('=', 1)[1],
+                                                      sep=' ').reshape((4, 4))
+                    break
+        rotation = axis_align_matrix[0:3, 0:3].astype(np.float32)
+        translation = axis_align_matrix[0:3, 3].astype(np.float32)
+        xyz = mesh_vertices[:, 0:3]
+        np.matmul(xyz, rotation.T, out=xyz)
+        xyz += translation
 
         # Load instance and semantic labels.
         object_id_to_segs, label_to_segs = self.read_aggregation(agg_file)
-        seg_to_verts, num_verts = self.read_segmentation(seg_file)
+        seg_row, indptr, indices = self.read_segmentation(seg_file)
+        num_verts = indices.shape[0]
 
-        label_ids = np.zeros(shape=(num_verts), dtype=np.uint32)
-        object_id_to_label_id = {}
+        row_label = np.zeros(len(seg_row), dtype=np.uint8)
         for label, segs in label_to_segs.items():
-            label_id = label_map[label]
-            for seg in segs:
-                verts = seg_to_verts[seg]
-                label_ids[verts] = label_id
+            row_label[[seg_row[seg] for seg in segs]] = label_map[label]
 
-        instance_ids = np.zeros(shape=(num_verts),
-                                dtype=np.uint32)  # 0: unannotated
-        num_instances = len(np.unique(list(object_id_to_segs.keys())))
+        row_object = np.zeros(len(seg_row), dtype=np.uint16)
+        object_id_to_label_id = {}
+        num_instances = len(object_id_to_segs)
         for object_id, segs in object_id_to_segs.items():
-            for seg in segs:
-                verts = seg_to_verts[seg]
-                instance_ids[verts] = object_id
-                if object_id not in object_id_to_label_id:
-                    object_id_to_label_id[object_id] = label_ids[verts][0]
+            rows = [seg_row[seg] for seg in segs]
+            row_object[rows] = object_id
+            if rows:
+                object_id_to_label_id[object_id] = row_label[rows[0]]
+
+        label_ids = np.zeros(shape=(num_verts), dtype=np.uint8)
+        instance_ids = np.zeros(shape=(num_verts),
+                                dtype=np.uint16)  # 0: unannotated
+        self.scatter_labels(indptr, indices, row_label, row_object, label_ids,
+                            instance_ids)
+
+        # Group vertices by instance and reduce each group to its extent.
+        order = np.argsort(instance_ids, kind='stable')
+        sorted_ids = instance_ids[order]
+        sorted_xyz = mesh_vertices[order, 0:3]
+        boundaries = np.r_[0, np.flatnonzero(np.diff(sorted_ids)) + 1]
+        obj_ids = sorted_ids[boundaries]
+        mins = np.minimum.reduceat(sorted_xyz, boundaries, axis=0)
+        maxs = np.maximum.reduceat(sorted_xyz, boundaries, axis=0)
+
+        annotated = obj_ids != 0
+        obj_ids = obj_ids[annotated]
+        mins = mins[annotated]
+        maxs = maxs[annotated]
+        obj_labels = [object_id_to_label_id[obj_id] for obj_id in obj_ids]
 
         instance_bboxes = np.zeros((num_instances, 7))
-        for obj_id in object_id_to_segs:
-            label_id = object_id_to_label_id[obj_id]
-            obj_pc = mesh_vertices[instance_ids == obj_id, 0:3]
-            if len(obj_pc) == 0:
-                continue
-            xmin = np.min(obj_pc[:, 0])
-            ymin = np.min(obj_pc[:, 1])
-            zmin = np.min(obj_pc[:, 2])
-            xmax = np.max(obj_pc[:, 0])
-            ymax = np.max(obj_pc[:, 1])
-            zmax = np.max(obj_pc[:, 2])
-            bbox = np.array([(xmin + xmax) / 2, (ymin + ymax) / 2,
-                             (zmin + zmax) / 2, xmax - xmin, ymax - ymin,
-                             zmax - zmin, label_id])
-            # NOTE: this assumes obj_id is in 1,2,3,.,,,.NUM_INSTANCES
-            instance_bboxes[obj_id - 1, :] = bbox
+        # NOTE: this assumes obj_id is in 1,2,3,.,,,.NUM_INSTANCES
+        instance_bboxes[obj_ids - 1, 0:3] = (mins + maxs) / 2
+        instance_bboxes[obj_ids - 1, 3:6] = maxs - mins
+        instance_bboxes[obj_ids - 1, 6] = obj_labels
 
         return mesh_vertices, label_ids, instance_ids,\
             instance_bboxes, object_id_to_label_id
 
+    @staticmethod
+    def scatter_labels(indptr, indices, row_label, row_object, out_label,
+                       out_instance):
+        """Write per-segment semantic and instance labels to their vertices.
+
+        Args:
+            indptr(np.ndarray): CSR row pointers, vertices of segment row i
+                are indices[indptr[i]:indptr[i + 1]].
+            indices(np.ndarray): Vertex indices of all segments.
+            row_label(np.ndarray): Semantic label of each segment row.
+            row_object(np.ndarray): Instance id of each segment row.
+            out_label(np.ndarray): Per-vertex semantic labels, updated in place.
+            out_instance(np.ndarray): Per-vertex instance ids, updated in place.
+        """
+        counts = np.diff(indptr)
+        out_label[indices] = np.repeat(row_label, counts)
+        out_instance[indices] = np.repeat(row_object, counts)
+
     @staticmethod
     def read_label_mapping(filename,
                            label_from='raw_category',
@@ -211,10 +330,13 @@ class ScannetProcess():
             Vertices. Note that RGB values are in 0-255.
         """
         assert os.path.isfile(filename)
-        data = o3d.t.io.read_point_cloud(filename)
-        points = data.point["positions"].numpy().astype(np.float32)
-        colors = data.point["colors"].numpy().astype(np.float32)
-        vertices = np.concatenate([points, colors], axis=1)
+        pcd = o3d.t.io.read_point_cloud(filename).point
+        points = pcd["positions"].numpy()
+        # Fill a single buffer instead of casting and concatenating, the
+        # assignment casts to float32 in the same pass.
+        vertices = np.empty((points.shape[0], 6), dtype=np.float32)
+        vertices[:, 0:3] = points
+        vertices[:, 3:6] = pcd["colors"].numpy()
         return vertices
 
     @staticmethod
@@ -222,35 +344,41 @@ class ScannetProcess():
         assert os.path.isfile(filename)
         object_id_to_segs = {}
         label_to_segs = {}
-        with open(filename) as f:
-            data = json.load(f)
-            num_objects = len(data['segGroups'])
-            for i in range(num_objects):
-                object_id = data['segGroups'][i][
-                    'objectId'] + 1  # instance ids should be 1-indexed
-                label = data['segGroups'][i]['label']
-                segs = data['segGroups'][i]['segments']
-                object_id_to_segs[object_id] = segs
-                if label in label_to_segs:
-                    label_to_segs[label].extend(segs)
-                else:
-                    label_to_segs[label] = segs
+        data = load_json(filename)
+        num_objects = len(data['segGroups'])
+        for i in range(num_objects):
+            object_id = data['segGroups'][i][
+                'objectId'] + 1  # instance ids should be 1-indexed
+            label = data['segGroups'][i]['label']
+            segs = data['segGroups'][i]['segments']
+            object_id_to_segs[object_id] = segs
+            if label in label_to_segs:
+                label_to_segs[label].extend(segs)
+            else:
+                label_to_segs[label] = segs
         return object_id_to_segs, label_to_segs
 
     @staticmethod
     def read_segmentation(filename):
+        """Read the segment of each vertex as a CSR structure.
+
+        Args:
+            filename(str): The name of the segmentation file.
+
+        Returns:
+            A dict mapping segment ids to CSR rows, the row pointers and the
+            vertex indices of all rows.
+        """
         assert os.path.isfile(filename)
-        seg_to_verts = {}
-        with open(filename) as f:
-            data = json.load(f)
-            num_verts = len(data['segIndices'])
-            for i in range(num_verts):
-                seg_id = data['segIndices'][i]
-                if seg_id in seg_to_verts:
-                    seg_to_verts[seg_id].append(i)
-                else:
-                    seg_to_verts[seg_id] = [i]
-        return seg_to_verts, num_verts
+        data = load_json(filename)
+        seg_arr = np.asarray(data['segIndices'], dtype=np.int32)
+
+        order = np.argsort(seg_arr, kind='stable')
+        seg_ids, starts = np.unique(seg_arr[order], return_index=True)
+        indptr = np.append(starts, seg_arr.shape[0]).astype(np.int32)
+        indices = order.astype(np.int32)
+        seg_row = {seg_id: i for i, seg_id in enumerate(seg_ids.tolist())}
+        return seg_row, indptr, indices
 
 
 if __name__ == '__main__':
@@ -264,5 +392,7 @@ if __name__ == '__main__':
     out_path = args.out_path
     if out_path is None:
         args.out_path = args.dataset_path
-    converter = ScannetProcess(args.dataset_path, args.out_path)
+    converter = ScannetProcess(args.dataset_path,
+                               args.out_path,
+                               overwrite=args.overwrite)
     converter.convert()